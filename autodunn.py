@@ -1,6 +1,7 @@
 """Sends dunning emails based on a report from enmnhtransactions"""
 
 import logging
+import time
 from pathlib import Path
 from pprint import pprint
 
@@ -10,7 +11,14 @@ from nmnh_ms_tools.records.transactions import Transaction, create_transaction
 from nmnh_ms_tools.utils import prompt
 from xmu import EMuReader, EMuRecord, write_group
 
-from config.dunns import Dunn, prep_loans, save_preflight
+from config.dunns import (
+    Dunn,
+    load_checkpoint,
+    prep_loans,
+    prioritize_loans,
+    save_checkpoint,
+    save_preflight,
+)
 
 
 # Set up logger to provide detailed info
@@ -62,62 +70,94 @@ if __name__ == "__main__":
                 )
     irns = {r["irn"] for r in dunned + skipped}
 
-    # Iterate through the export file to get item data for each transaction
-    reader = EMuReader("xmldata.xml")
-    transactions = {}
-    for rec in reader:
-        transactions[int(rec["TraNumber"])] = create_transaction(rec)
-        if (
-            Transaction.trn_config["debug_num"]
-            and rec["TraNumber"] != Transaction.trn_config["debug_num"]
-        ):
-            continue
-        if Transaction.trn_config["debug_num"]:
-            pprint(rec)
-        reader.report_progress()
-
-    # Remove closed transactions and all associated metadata from preflight
-    if Transaction.trn_config["remove_closed_transactions"]:
-        try:
-            df = pd.read_excel("preflight.xlsx")
-        except FileNotFoundError:
-            pass
-        else:
-            df["DueDate"] = df["DueDate"].dt.date
-            df["LastInteraction"] = df["LastInteraction"].dt.date
-            active = df[df["TransactionNumber"].isin(transactions)]
-            active.fillna("").to_excel(
-                "preflight.xlsx", sheet_name="Loans", index=False, freeze_panes=(1, 0)
-            )
+    # Resume from the checkpoint left by a previous run if one exists. The
+    # checkpoint holds the prioritized loans that still need to be processed,
+    # so the export does not need to be parsed again.
+    checkpoint = Path("checkpoint.pkl")
+    loans = load_checkpoint(checkpoint)
+    if loans is not None:
+        msg = f"Resuming from checkpoint ({len(loans):,} loans remaining)"
+        logging.info(msg)
+        print(msg)
+    else:
+        # Iterate through the export file to get item data for each transaction
+        reader = EMuReader("xmldata.xml")
+        transactions = {}
+        for rec in reader:
+            transactions[int(rec["TraNumber"])] = create_transaction(rec)
+            if (
+                Transaction.trn_config["debug_num"]
+                and rec["TraNumber"] != Transaction.trn_config["debug_num"]
+            ):
+                continue
+            if Transaction.trn_config["debug_num"]:
+                pprint(rec)
+            reader.report_progress()
+
+        # Remove closed transactions and all associated metadata from preflight
+        if Transaction.trn_config["remove_closed_transactions"]:
+            try:
+                df = pd.read_excel("preflight.xlsx")
+            except FileNotFoundError:
+                pass
+            else:
+                df["DueDate"] = df["DueDate"].dt.date
+                df["LastInteraction"] = df["LastInteraction"].dt.date
+                active = df[df["TransactionNumber"].isin(transactions)]
+                active.fillna("").to_excel(
+                    "preflight.xlsx",
+                    sheet_name="Loans",
+                    index=False,
+                    freeze_panes=(1, 0),
+                )
+
+        # Prepare loans
+        loans = prep_loans(transactions)
 
-    # Prepare loans
-    loans = prep_loans(transactions)
-
-    # Warn user when preparing to send emails
-    if not Dunn.trn_config["debug"]:
-        resp = prompt(
-            "***The script will send out actual dunning emails to actual"
-            " people! Are you sure you want to continue?***",
-            {"y": True, "n": False},
-        )
-        if resp and not Dunn.trn_config["safe_send"]:
+        # Warn user when preparing to send emails
+        if not Dunn.trn_config["debug"]:
             resp = prompt(
-                "***You have disabled the safe send option! This is your"
-                " last chance to bail before sending a dunning letter to"
-                " everyone with an overdue loan. Are you sure you want to"
-                " continue?***",
+                "***The script will send out actual dunning emails to actual"
+                " people! Are you sure you want to continue?***",
                 {"y": True, "n": False},
             )
-        if not resp:
-            raise RuntimeError("User chose not to proceed")
+            if resp and not Dunn.trn_config["safe_send"]:
+                resp = prompt(
+                    "***You have disabled the safe send option! This is your"
+                    " last chance to bail before sending a dunning letter to"
+                    " everyone with an overdue loan. Are you sure you want to"
+                    " continue?***",
+                    {"y": True, "n": False},
+                )
+            if not resp:
+                raise RuntimeError("User chose not to proceed")
+
+        # Filter and prioritize loans
+        loans = [t for t in loans if t.is_open() and t.contact]
+        loans = prioritize_loans(loans)
 
-    # Filter and sort loans
-    loans = [t for t in loans if t.is_open() and t.contact]
-    loans = sorted(loans, key=lambda t: t.contact.name)
+    # Limit the number of dunns and the time spent on a single run. Loans not
+    # processed before the budget runs out are saved to the checkpoint file.
+    max_dunns = Dunn.trn_config.get("max_dunns")
+    max_minutes = Dunn.trn_config.get("max_minutes")
+    start_time = time.time()
+    num_dunns = 0
 
     # Dunn loans and find errors
+    i = 0
     try:
-        for loan in loans:
+        for i, loan in enumerate(loans):
+            # Stop if the budget for this run has been used up
+            if max_dunns and num_dunns >= max_dunns:
+                msg = f"Reached maximum number of dunns ({max_dunns:,})"
+                logging.info(msg)
+                print(msg)
+                break
+            if max_minutes and time.time() - start_time >= 60 * max_minutes:
+                msg = f"Reached maximum run time ({max_minutes:,} minutes)"
+                logging.info(msg)
+                print(msg)
+                break
             tranum = loan["TraNumber"]
             # Check for debug number
             if Dunn.trn_config["debug_num"] and tranum != Dunn.trn_config["debug_num"]:
@@ -144,7 +184,10 @@ if __name__ == "__main__":
                     logging.info(msg)
                     print(msg)
                     dunned.append(rec)
-        print("Done!")
+                    num_dunns += 1
+        else:
+            i = len(loans)
+            print("Done!")
     except:
         raise
     finally:
@@ -154,4 +197,20 @@ if __name__ == "__main__":
             write_group(dunned, grp_dunned, name="DMS_DunnSucceeded")
         if skipped:
             write_group(skipped, grp_skipped, name="DMS_DunnFailed")
-        save_preflight(loan.preflight, "preflight.xlsx", False)
+        save_preflight(Dunn.preflight, "preflight.xlsx", False)
+        # Save unprocessed loans so the next run can pick up where this one
+        # stopped. Loans processed during this run are recorded in the group
+        # files and will be skipped when the run resumes.
+        if loans[i:]:
+            try:
+                save_checkpoint(loans[i:], checkpoint)
+            except Exception:
+                logging.exception(f"Could not save {checkpoint}")
+                print(f"Could not save {checkpoint}")
+                checkpoint.unlink(missing_ok=True)
+            else:
+                msg = f"Saved {len(loans[i:]):,} unprocessed loans to {checkpoint}"
+                logging.info(msg)
+                print(msg)
+        elif checkpoint.exists():
+            checkpoint.unlink()
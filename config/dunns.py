@@ -1,5 +1,6 @@
 import logging
 import os
+import pickle
 import re
 import time
 import warnings
@@ -28,6 +29,9 @@ AUTODUNN_CODES = [
 ]
 CONFIG_DIR = Path(__file__).parent
 
+# Settings that must match for a run to resume from a checkpoint
+CHECKPOINT_KEYS = ["debug", "debug_num", "safe_send", "send_to_me"]
+
 
 class Dunn(LoanOutgoing):
     """Container for transactions to dunn"""
@@ -69,6 +73,50 @@ class Dunn(LoanOutgoing):
             logging.warning("\n".join(errors))
             return False
 
+        subject, body, preview, coll_email, supervisor = self.render(preflight)
+
+        fp = os.path.join("letters", f"{self['TraNumber']}_{self.level}.htm")
+        with open(fp, "w", encoding="utf-8", newline="") as f:
+            f.write(preview)
+
+        sent = False
+        if send or self.trn_config["send_to_me"]:
+            if self.trn_config["safe_send"]:
+                # Preview the dunning email if using safe send
+                wb.open(fp)
+            elif self.trn_config["debug"] and not self.trn_config["send_to_me"]:
+                # Last chance to trap errors before you actually send an email
+                raise Exception("Trying to send email while in debug mode")
+
+            self.send(
+                subject,
+                body,
+                self.contact.email,
+                coll_email,
+                supervisor,
+            )
+            if not self.trn_config["safe_send"]:
+                time.sleep(1)
+
+            sent = True
+
+        # Group XML files used to track recent dunns instead
+        # if sent:
+        #    cond = self.preflight["TransactionNumber"] == self["TraNumber"]
+        #    self.preflight.loc[cond, "LastInteraction"] = datetime.now()
+        #    save_preflight(self.preflight, "preflight.xlsx", False)
+
+        return sent if (send or self.trn_config["send_to_me"]) else True
+
+    def render(self, preflight, ask_supervisor=True):
+        """Builds the dunning letter without writing or sending it
+
+        Returns the subject, body, and HTML preview of the letter, plus the
+        collections and supervisor emails needed to send it. If ask_supervisor
+        is False, escalated letters that do not have a supervisor email in the
+        preflight file use a placeholder instead of prompting the user.
+        """
+
         return_date = datetime.now() + timedelta(days=30)
         mailing_address = (
             self.trn_config["mailing_address"]
@@ -113,7 +161,9 @@ class Dunn(LoanOutgoing):
         # Escalate if previous dunning letters have been ignored
         supervisor = None
         if self.escalate():
-            supervisor = self.get_supervisor(preflight, dunn_info)
+            supervisor = self.get_supervisor(preflight, dunn_info, ask_supervisor)
+            if not supervisor:
+                supervisor = "[Supervisor email required]"
 
         # Customize intro based on whether this is a reminder
         intro_key = "intro_due" if self.is_overdue() else "intro_reminder"
@@ -156,52 +206,23 @@ class Dunn(LoanOutgoing):
         if self.trn_config["debug"]:
             subject += " [DEBUG]"
 
-        fp = os.path.join("letters", f"{self['TraNumber']}_{self.level}.htm")
-        with open(fp, "w", encoding="utf-8", newline="") as f:
-            # Add subject and recipients to the HTML preview
-            metadata = [
-                "<span class='metadata'>Subject:</span> " + subject,
-                "<span class='metadata'>To:</span> " + self.contact.email,
-            ]
-            if supervisor:
-                cc = "; ".join((self.contact.email, dunn_info["coll_email"]))
-                # Flip the cc/to emails if escalating
-                metadata[1] = "<span class='metadata'>To:</span> " + supervisor
-                metadata.append("<span class='metadata'>Cc:</span> " + cc)
-            else:
-                cc = dunn_info["coll_email"]
-                metadata.append("<span class='metadata'>Cc:</span> " + cc)
-            recipients = "<body>\n<p>" + "<br>".join(metadata) + "</p><hr />"
-            f.write(body.replace("<body>", recipients))
-
-        sent = False
-        if send or self.trn_config["send_to_me"]:
-            if self.trn_config["safe_send"]:
-                # Preview the dunning email if using safe send
-                wb.open(fp)
-            elif self.trn_config["debug"] and not self.trn_config["send_to_me"]:
-                # Last chance to trap errors before you actually send an email
-                raise Exception("Trying to send email while in debug mode")
-
-            self.send(
-                subject,
-                body,
-                self.contact.email,
-                dunn_info["coll_email"],
-                supervisor,
-            )
-            if not self.trn_config["safe_send"]:
-                time.sleep(1)
-
-            sent = True
-
-        # Group XML files used to track recent dunns instead
-        # if sent:
-        #    cond = self.preflight["TransactionNumber"] == self["TraNumber"]
-        #    self.preflight.loc[cond, "LastInteraction"] = datetime.now()
-        #    save_preflight(self.preflight, "preflight.xlsx", False)
+        # Add subject and recipients to the HTML preview
+        metadata = [
+            "<span class='metadata'>Subject:</span> " + subject,
+            "<span class='metadata'>To:</span> " + self.contact.email,
+        ]
+        if supervisor:
+            cc = "; ".join((self.contact.email, dunn_info["coll_email"]))
+            # Flip the cc/to emails if escalating
+            metadata[1] = "<span class='metadata'>To:</span> " + supervisor
+            metadata.append("<span class='metadata'>Cc:</span> " + cc)
+        else:
+            cc = dunn_info["coll_email"]
+            metadata.append("<span class='metadata'>Cc:</span> " + cc)
+        recipients = "<body>\n<p>" + "<br>".join(metadata) + "</p><hr />"
+        preview = body.replace("<body>", recipients)
 
-        return sent if (send or self.trn_config["send_to_me"]) else True
+        return subject, body, preview, dunn_info["coll_email"], supervisor
 
     def to_preflight(self):
         """Maps basic metadata to the fields used in the preflight file"""
@@ -251,7 +272,7 @@ class Dunn(LoanOutgoing):
                     return ""
                 raise
 
-    def get_supervisor(self, preflight, dunn_info):
+    def get_supervisor(self, preflight, dunn_info, ask=True):
         """Determines supervisor of contact for a loan with too many dunns"""
         supervisor = preflight["SupervisorEmail"]
         key = "{name} ({org})".format(**dunn_info)
@@ -259,6 +280,8 @@ class Dunn(LoanOutgoing):
             try:
                 supervisor = self._supervisors[key]
             except KeyError:
+                if not ask:
+                    return None
                 print(
                     "This is the {nth} dunning letter for"
                     " {tranum}!".format(**dunn_info)
@@ -522,7 +545,18 @@ def prep_loans(transactions, fp="preflight.csv"):
     return loans
 
 
-def save_preflight(df, path, exit_on_change=True):
+def read_preflight(path="preflight.xlsx"):
+    """Reads an existing preflight file with dates parsed"""
+    preflight = pd.read_excel(path)
+    # Empty text columns are read as floats, which cannot hold strings
+    for col in ["SupervisorEmail", "DoNotDunn"]:
+        preflight[col] = preflight[col].astype(object)
+    preflight["DueDate"] = pd.to_datetime(preflight["DueDate"])
+    preflight["LastInteraction"] = pd.to_datetime(preflight["LastInteraction"])
+    return preflight
+
+
+def save_preflight(df, path, exit_on_change=True, retry=True):
     df["DueDate"] = df["DueDate"].dt.date
     df["LastInteraction"] = df["LastInteraction"].dt.date
     df = df.sort_values("TransactionNumber", ascending=False)
@@ -533,6 +567,8 @@ def save_preflight(df, path, exit_on_change=True):
             )
             break
         except PermissionError:
+            if not retry:
+                raise
             input(
                 f"Could not save {path}! Please close the file and hit ENTER to try again"
             )
@@ -545,6 +581,78 @@ def save_preflight(df, path, exit_on_change=True):
         sys.exit()
 
 
+def prioritize_loans(loans):
+    """Sorts loans so that the most urgent dunns are sent first
+
+    Recalls go first, followed by escalations, then loans that are the most
+    overdue and have the most outstanding items.
+    """
+
+    def _key(loan):
+        days_overdue = 0
+        if loan.due_date:
+            due_date = pd.to_datetime(loan.due_date.value, errors="coerce")
+            if not pd.isna(due_date):
+                days_overdue = (datetime.now() - due_date).days
+        num_outstanding = len([i for i in loan.tr_items if i.is_outstanding()])
+        return (
+            loan.level != "recall",
+            not loan.escalate(),
+            -days_overdue,
+            -num_outstanding,
+            loan.contact.name,
+        )
+
+    return sorted(loans, key=_key)
+
+
+def save_checkpoint(loans, path):
+    """Saves the loans remaining at the end of a run so the next run can resume"""
+    checkpoint = {k: Dunn.trn_config[k] for k in CHECKPOINT_KEYS}
+    checkpoint["loans"] = loans
+    # Write to a temporary file first so an interrupted write does not leave
+    # a partial checkpoint behind
+    tmp = Path(path).with_suffix(".tmp")
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(checkpoint, f)
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def load_checkpoint(path, export="xmldata.xml"):
+    """Loads the loans remaining from a previous run
+
+    Returns None if there is no checkpoint, if the checkpoint is older than
+    the export or cannot be read, or if the settings that control sending
+    have changed since it was written. The preflight is read from the current
+    preflight file so that changes made since the last run (for example, to
+    DoNotDunn) are respected.
+    """
+    try:
+        if Path(export).stat().st_mtime > Path(path).stat().st_mtime:
+            Path(path).unlink()
+            return None
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logging.exception(f"Could not read {path}")
+        Path(path).unlink()
+        return None
+    if any(checkpoint.get(k) != Dunn.trn_config[k] for k in CHECKPOINT_KEYS):
+        logging.info(f"Settings changed since {path} was saved")
+        Path(path).unlink()
+        return None
+    try:
+        Dunn.preflight = read_preflight()
+    except FileNotFoundError:
+        return None
+    return checkpoint["loans"]
+
+
 def _greeting(contact) -> str:
     """Determines the proper greeting for a dunning letter"""
     if contact.is_person():
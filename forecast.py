@@ -0,0 +1,106 @@
+"""Forecasts the number of dunns that will be due over the coming months"""
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from config.dunns import Dunn, is_empty, read_preflight
+
+
+# Loans with these codes are expected to become dunnable later. Loans with any
+# other DoNotDunn entry are left out of the forecast.
+FORECAST_CODES = [
+    "[AUTODUNN] Not due yet",
+    "[AUTODUNN] Recent interaction",
+]
+
+
+def forecast_dunns(preflight, months=6, start=None):
+    """Projects dunns, escalations, and recalls by week and catalog
+
+    Dunns are projected using the settings in config.yml. A loan becomes
+    dunnable once it is more than grace_period days overdue and num_days have
+    passed since the last interaction, then is dunned again every num_days.
+    Reminders for loans that are almost due are not included.
+    """
+    config = Dunn.trn_config
+
+    if start is None:
+        start = config["overdue_date"] or datetime.now()
+    start = pd.Timestamp(start).normalize()
+    weeks = pd.date_range(start, start + pd.DateOffset(months=months), freq="7D")
+
+    cond = preflight["DoNotDunn"].apply(is_empty).astype(bool)
+    cond = cond | preflight["DoNotDunn"].isin(FORECAST_CODES)
+    loans = preflight.loc[cond & preflight["DueDate"].notna()]
+
+    interval = max(config["num_days"], 1)
+    day = np.timedelta64(1, "D")
+
+    # Find the first date on which each loan can be dunned, measured in days
+    # from the start of the forecast
+    due = loans["DueDate"].values
+    last = loans["LastInteraction"].values
+    first = due + np.timedelta64(config["grace_period"] + 1, "D")
+    first = np.fmax(first, last + np.timedelta64(config["num_days"], "D"))
+    first = np.fmax((first - start.to_datetime64()) / day, 0)
+
+    # Count the dunns falling in each week using a loan x week matrix. Loans
+    # are dunned on day first + k * interval for k = 0, 1, 2...
+    week_start = ((weeks - start) / pd.Timedelta(days=1)).values
+    week_end = week_start + 7
+    num_before = np.clip(
+        np.ceil((week_start[None, :] - first[:, None]) / interval), 0, None
+    )
+    num_before_end = np.clip(
+        np.ceil((week_end[None, :] - first[:, None]) / interval), 0, None
+    )
+    dunns = num_before_end - num_before
+
+    # Escalate once the total number of dunns reaches the configured threshold
+    if config["escalate"]:
+        num_dunns = loans["DunnCount"].fillna(0).values[:, None] + num_before
+        escalations = dunns * (num_dunns >= config["escalate"])
+    else:
+        escalations = np.zeros_like(dunns)
+
+    # Recall loans due before the recall date, which defaults to two years
+    # before the date of the dunn
+    if config["recall_date"]:
+        recall_date = pd.Timestamp(config["recall_date"]).to_datetime64()
+        is_recall = (due < recall_date)[:, None]
+    else:
+        is_recall = due[:, None] < (weeks - pd.DateOffset(years=2)).values[None, :]
+    recalls = dunns * is_recall
+
+    # Sum the matrices by catalog code
+    catalogs = loans["Catalog"].fillna("").values
+    cols = {}
+    for key, vals in {
+        "Dunns": dunns,
+        "Escalations": escalations,
+        "Recalls": recalls,
+    }.items():
+        df = pd.DataFrame(vals, index=catalogs, columns=weeks.date)
+        cols[key] = df.groupby(level=0).sum().stack()
+    forecast = pd.DataFrame(cols).astype(int)
+    forecast.index.names = ["Catalog", "Week"]
+    return (
+        forecast.swaplevel()
+        .sort_index()
+        .reset_index()
+        .query("Dunns > 0")
+        .reset_index(drop=True)
+    )
+
+
+if __name__ == "__main__":
+
+    months = Dunn.trn_config.get("forecast_months") or 6
+    forecast = forecast_dunns(read_preflight(), months)
+    forecast.to_excel(
+        "forecast.xlsx", sheet_name="Forecast", index=False, freeze_panes=(1, 0)
+    )
+    print(forecast.groupby("Week")[["Dunns", "Escalations", "Recalls"]].sum())
+    print(f"Saved forecast for the next {months} months to forecast.xlsx")
@@ -0,0 +1,206 @@
+"""Serves a local preview of dunning letters for review before sending"""
+
+import hmac
+import logging
+import secrets
+import threading
+from functools import lru_cache
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from nmnh_ms_tools.records.transactions import LoanOutgoing, create_transaction
+from xmu import EMuReader
+
+from config.dunns import Dunn, is_empty, read_preflight, save_preflight
+
+
+# Set up logger to provide detailed info
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=getattr(logging, "INFO"),
+    handlers=[
+        logging.FileHandler("autodunn.log", "a", encoding="utf-8"),
+    ],
+)
+
+
+HOLD = "Held during preview"
+
+# Token included in the decisions form so that other web pages cannot submit
+# decisions to the preview server
+TOKEN = secrets.token_urlsafe()
+
+# Loans are read from the export in the background so that the server can
+# start listing the preflight immediately
+_loans = {}
+_loans_ready = threading.Event()
+_preflight_lock = threading.Lock()
+
+
+def load_loans(path="xmldata.xml"):
+    """Reads outgoing loans from the EMu export"""
+    try:
+        for rec in EMuReader(path):
+            trn = create_transaction(rec)
+            if isinstance(trn, LoanOutgoing):
+                _loans[int(rec["TraNumber"])] = Dunn(trn)
+    finally:
+        # Do not leave letter requests waiting if the export cannot be read
+        _loans_ready.set()
+    logging.info(f"Preview: Loaded {len(_loans):,} loans from {path}")
+
+
+@lru_cache(maxsize=256)
+def render_letter(tranum):
+    """Renders the letter for a single loan"""
+    _loans_ready.wait()
+    try:
+        loan = _loans[tranum]
+    except KeyError:
+        return f"<p>{tranum}: Not in export</p>"
+    errors = loan.find_errors()
+    if errors:
+        return "<p>" + "<br>".join(escape(e) for e in errors) + "</p>"
+    with _preflight_lock:
+        preflight = Dunn.preflight[Dunn.preflight["TransactionNumber"] == tranum]
+    if preflight.empty:
+        return f"<p>{tranum}: Not found in preflight</p>"
+    return loan.render(preflight.iloc[0], ask_supervisor=False)[2]
+
+
+def list_loans():
+    """Builds the index page listing dunnable and held loans"""
+    with _preflight_lock:
+        preflight = Dunn.preflight
+        cond = preflight["DoNotDunn"].apply(is_empty)
+        cond = cond | (preflight["DoNotDunn"] == HOLD)
+        rows = preflight[cond].to_dict("records")
+    html = [
+        "<html><head><title>autodunn preview</title></head><body>",
+        f"<h1>Dunnable loans ({len(rows):,})</h1>",
+        "<form method='post' action='/decisions'>",
+        f"<input type='hidden' name='token' value='{TOKEN}'>",
+        "<button name='action' value='approve'>Approve selected</button> ",
+        "<button name='action' value='hold'>Hold selected</button>",
+        "<table>",
+        "<tr><th></th><th>Transaction</th><th>Catalog</th><th>Level</th>"
+        "<th>Contact</th><th>Due date</th><th>Dunns</th><th>Status</th></tr>",
+    ]
+    for row in rows:
+        tranum = row["TransactionNumber"]
+        try:
+            due_date = row["DueDate"].strftime("%Y-%m-%d")
+        except (AttributeError, ValueError):
+            due_date = ""
+        html.append(
+            "<tr>"
+            f"<td><input type='checkbox' name='tranum' value='{tranum}'></td>"
+            f"<td><a href='/letters/{tranum}' target='letter'>{tranum}</a></td>"
+            f"<td>{escape(str(row['Catalog']))}</td>"
+            f"<td>{escape(str(row['Level']))}</td>"
+            f"<td>{escape(str(row['Contact']))}</td>"
+            f"<td>{due_date}</td>"
+            f"<td>{row['DunnCount']}</td>"
+            f"<td>{'Held' if row['DoNotDunn'] == HOLD else ''}</td>"
+            "</tr>"
+        )
+    html.append("</table></form></body></html>")
+    return "\n".join(html)
+
+
+def record_decisions(tranums, action, path="preflight.xlsx"):
+    """Writes approve/hold decisions to the DoNotDunn column of the preflight
+
+    The preflight file is read again before each change so that edits made
+    since the server started are kept. Raises a PermissionError without
+    changing the preflight if the file cannot be saved, for example, because
+    it is open in Excel.
+    """
+    if action not in ("approve", "hold"):
+        raise ValueError(f"Invalid action: {action}")
+    with _preflight_lock:
+        preflight = read_preflight(path)
+        cond = preflight["TransactionNumber"].isin(tranums)
+        if action == "hold":
+            cond = cond & preflight["DoNotDunn"].apply(is_empty)
+            preflight.loc[cond, "DoNotDunn"] = HOLD
+        else:
+            preflight.loc[cond & (preflight["DoNotDunn"] == HOLD), "DoNotDunn"] = ""
+        # save_preflight converts dates in place, so save a copy
+        save_preflight(preflight.copy(), path, False, retry=False)
+        Dunn.preflight = preflight
+        # Letters depend on other preflight columns, like SupervisorEmail
+        render_letter.cache_clear()
+    logging.info(f"Preview: Marked {sorted(tranums)} as {action}")
+
+
+class PreviewHandler(BaseHTTPRequestHandler):
+    """Handles requests for the loan list and individual letters"""
+
+    def do_GET(self):
+        if self.path == "/":
+            self._respond(list_loans())
+        elif self.path.startswith("/letters/"):
+            try:
+                tranum = int(self.path.rsplit("/", 1)[-1])
+            except ValueError:
+                self.send_error(404)
+            else:
+                self._respond(render_letter(tranum))
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != "/decisions":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode("utf-8"))
+        if not hmac.compare_digest(form.get("token", [""])[0], TOKEN):
+            self.send_error(403, "Invalid token. Reload the preview and try again.")
+            return
+        try:
+            tranums = [int(t) for t in form.get("tranum", [])]
+            record_decisions(tranums, form.get("action", [""])[0])
+        except ValueError as exc:
+            self.send_error(400, str(exc))
+            return
+        except PermissionError:
+            self.send_error(
+                409, "Could not save preflight.xlsx. Close the file and try again."
+            )
+            return
+        self.send_response(303)
+        self.send_header("Location", "/")
+        self.end_headers()
+
+    def _respond(self, html):
+        content = html.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.info("Preview: " + format % args)
+
+
+if __name__ == "__main__":
+
+    logging.info("===================")
+    logging.info("Running preview.py")
+
+    Dunn.preflight = read_preflight()
+    threading.Thread(target=load_loans, daemon=True).start()
+
+    port = Dunn.trn_config.get("preview_port") or 8000
+    server = ThreadingHTTPServer(("127.0.0.1", port), PreviewHandler)
+    print(f"Previewing letters at http://127.0.0.1:{port}/ (CTRL+C to quit)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()